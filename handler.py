@@ -1,7 +1,27 @@
 import argparse
 import hashlib
+import mmap
 import os
-from collections import defaultdict
+import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+
+try:
+    from blake3 import blake3
+except ImportError:
+    blake3 = None
+
+PARTIAL_BLOCK = 4096
+MIN_HASH_BLOCK = 1 << 15
+MAX_HASH_BLOCK = 1 << 20
+MMAP_SIZE = 4 << 20
+BLAKE3_MMAP_SIZE = 16 << 20
+WORKERS = min(32, (os.cpu_count() or 1) * 4)
+HASH_NAME = "blake3" if blake3 else "sha256"
+CACHE_PATH = os.path.expanduser("~/.cache/duplemove/hashes.db")
+CACHE_VERSION = 1
+OUTPUT_LINES = 1024
 
 
 def get_path():
@@ -17,26 +37,75 @@ def get_path():
         return args.path
 
 
+def scan_dir(path: str, form: str = ""):
+    """
+    Scans one directory for files ending with given file format and for subdirectories.
+
+    :param path: Path to directory
+    :param form: File format for file to endswith
+    :return: Tuple ([(size, path) of files], [paths to subdirectories])
+    """
+    files = []
+    dirs = []
+    try:
+        entries = os.scandir(path)
+    except OSError:
+        return files, dirs
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.path)
+            elif form and not entry.name.endswith(form):
+                continue
+            elif entry.is_file(follow_symlinks=False):
+                files.append((entry.stat(follow_symlinks=False).st_size, entry.path))
+    return files, dirs
+
+
+def walk_dirs(dirs: list, form: str = ""):
+    """
+    Walks given directories with their subdirectories one by one.
+
+    :param dirs: List of paths to directories
+    :param form: File format for file to endswith
+    :return: List [(size, path) of files]
+    """
+    files = []
+    dirs = list(dirs)
+    while dirs:
+        found, subdirs = scan_dir(dirs.pop(), form)
+        files.extend(found)
+        dirs.extend(subdirs)
+    return files
+
+
 def get_files(path: str, form: str = ""):
     """
     Returns dict of files {size: [paths]} from given directory grouped by size
     if they end with given file format. (Returns all files if form not given)
+    Subdirectories of given directory are split into chunks walked
+    concurrently in a thread pool, each chunk walked serially.
+    Sizes with a single file are left out.
 
     :param path: Absolute path to directory
     :param form: File format for file to endswith
     :return: Dict {size: [paths to files with same size]}
     """
-    lst = defaultdict(list)
-    for root, dirs, files in os.walk(path):
-        for i in files:
-            if i.endswith(form):
-                path = os.path.join(root, i)
-                size = os.stat(path).st_size
-                lst[size].append(path)
-    for k in tuple(lst.keys()):
-        if len(lst[k]) < 2:
-            del lst[k]
-    return lst
+    files, dirs = scan_dir(path, form)
+    chunks = min(len(dirs), WORKERS * 4) or 1
+    seen = {}
+    groups = {}
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        walked = executor.map(walk_dirs, [dirs[i::chunks] for i in range(chunks)], repeat(form))
+        for found in (files, *walked):
+            for size, file in found:
+                if size in groups:
+                    groups[size].append(file)
+                elif size in seen:
+                    groups[size] = [seen.pop(size), file]
+                else:
+                    seen[size] = file
+    return groups
 
 
 def choice_sorting():
@@ -54,19 +123,32 @@ def choice_sorting():
     return False if srt == "2" else True
 
 
-def print_files(lst: defaultdict, srt: bool):
+def write_lines(lines: list):
+    """
+    Writes given lines to stdout in one call and clears the list.
+
+    :param lines: List of lines to write
+    """
+    if lines:
+        sys.stdout.write("\n".join(lines) + "\n")
+        lines.clear()
+
+
+def print_files(lst: dict, srt_sizes: list):
     """
-    Prints files in given sorting order from given dict of files paths grouped by size.
+    Prints files in given sizes order from given dict of files paths grouped by size.
 
     :param lst: Dict of files paths grouped by size(key=size)
-    :param srt: False - Descending order; True - Ascending
+    :param srt_sizes: Sorted list of sizes (keys of lst)
     """
-    srt_keys = sorted(lst, reverse=srt)
-    for i in srt_keys:
-        print()
-        print(i, "bytes")
-        for f in lst[i]:
-            print(f)
+    out = []
+    for i in srt_sizes:
+        out.append("")
+        out.append(f"{i} bytes")
+        out.extend(lst[i])
+        if len(out) >= OUTPUT_LINES:
+            write_lines(out)
+    write_lines(out)
 
 
 def ask_yes_no(question: str):
@@ -83,78 +165,323 @@ def ask_yes_no(question: str):
     return 0 if rep in ("n", "no") else 1
 
 
-def check_hashes(files: list):
-    """Takes list of paths to files. Checks their hashes,
+def get_partial_hash(file: str):
+    """
+    Returns hash of the first and the last blocks of file.
+    File must be larger than two blocks.
+
+    :param file: Path to file
+    :return: Partial hash digest
+    """
+    with open(file, "rb") as f:
+        head = f.read(PARTIAL_BLOCK)
+        f.seek(-PARTIAL_BLOCK, os.SEEK_END)
+        tail = f.read(PARTIAL_BLOCK)
+    return hashlib.blake2b(head + tail, digest_size=16).digest()
+
+
+def new_hash():
+    """
+    Returns new hash object: blake3 if installed, otherwise sha256.
+
+    :return: Hash object
+    """
+    return blake3() if blake3 else hashlib.sha256()
+
+
+def hash_block_size(size: int):
+    """
+    Returns read block size for hashing file of given size.
+    Block size grows with file size from MIN_HASH_BLOCK to MAX_HASH_BLOCK.
+
+    :param size: Size of file in bytes
+    :return: Block size in bytes
+    """
+    return min(MAX_HASH_BLOCK, max(MIN_HASH_BLOCK, size // 16))
+
+
+def is_hash_mapped(size: int):
+    """
+    Tells if get_hash maps file of given size into memory instead of reading it in blocks.
+
+    :param size: Size of file in bytes
+    :return: True if file is mapped
+    """
+    return bool(blake3 and size > BLAKE3_MMAP_SIZE) or (
+        size > MMAP_SIZE and hasattr(mmap, "MADV_SEQUENTIAL")
+    )
+
+
+def get_hash(file: str, size: int):
+    """
+    Returns hash of file content read in blocks into reused buffer.
+    Large files are hashed by multithreaded blake3 over mmap if it is installed.
+    Other files over MMAP_SIZE are mapped into memory instead of being read
+    where madvise is available.
+
+    :param file: Path to file
+    :param size: Size of file in bytes
+    :return: Hash hexdigest
+    """
+    if blake3 and size > BLAKE3_MMAP_SIZE:
+        h = blake3(max_threads=blake3.AUTO)
+        h.update_mmap(file)
+        return h.hexdigest()
+    with open(file, "rb", buffering=0) as f:
+        if is_hash_mapped(size):
+            h = new_hash()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+                h.update(mm)
+            return h.hexdigest()
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        h = new_hash()
+        buf = bytearray(hash_block_size(size))
+        view = memoryview(buf)
+        while n := f.readinto(buf):
+            h.update(view[:n])
+        return h.hexdigest()
+
+
+def compare_files(first: str, second: str, size: int):
+    """
+    Compares two files with same size block by block. Stops reading at first
+    differing block. Files that get_hash reads in blocks are hashed along the way,
+    larger files are hashed by get_hash after they matched.
+
+    :param first: Path to first file
+    :param second: Path to second file
+    :param size: Size of files in bytes
+    :return: Hash hexdigest if files are equal, otherwise None
+    """
+    hash_along = not is_hash_mapped(size)
+    h = new_hash()
+    block = hash_block_size(size)
+    with open(first, "rb") as f1, open(second, "rb") as f2:
+        while True:
+            data = f1.read(block)
+            if data != f2.read(block):
+                return None
+            if not data:
+                break
+            if hash_along:
+                h.update(data)
+    return h.hexdigest() if hash_along else get_hash(first, size)
+
+
+def open_cache():
+    """
+    Opens hashes cache database. Creates it if it doesn't exist
+    and recreates it if it has older format.
+
+    :return: Sqlite connection or None if cache is not available
+    """
+    try:
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        cache = sqlite3.connect(CACHE_PATH)
+        cache.execute("PRAGMA journal_mode=WAL")
+        if cache.execute("PRAGMA user_version").fetchone()[0] < CACHE_VERSION:
+            cache.execute("DROP TABLE IF EXISTS hashes")
+            cache.execute(f"PRAGMA user_version = {CACHE_VERSION}")
+        cache.execute(
+            "CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, ino INTEGER, "
+            "mtime_ns INTEGER, ctime_ns INTEGER, size INTEGER, algorithm TEXT, hash TEXT)"
+        )
+    except (OSError, sqlite3.Error):
+        return None
+    return cache
+
+
+def get_cached_hash(cache: sqlite3.Connection, file: str):
+    """
+    Looks up file hash in cache. Cached hash is valid while file path, inode,
+    modification time, change time and size are the same. Change time can't be
+    set back by user, so any rewrite of file invalidates its hash.
+
+    :param cache: Sqlite connection (open_cache())
+    :param file: Path to file
+    :return: Tuple (cache row key, cached hash or None) or None if file doesn't exist
+    """
+    try:
+        stat = os.stat(file)
+    except OSError:
+        return None
+    key = (
+        os.path.abspath(file),
+        stat.st_ino,
+        stat.st_mtime_ns,
+        stat.st_ctime_ns,
+        stat.st_size,
+        HASH_NAME,
+    )
+    try:
+        row = cache.execute(
+            "SELECT hash FROM hashes WHERE path = ? AND ino = ? AND mtime_ns = ? "
+            "AND ctime_ns = ? AND size = ? AND algorithm = ?",
+            key,
+        ).fetchone()
+    except sqlite3.Error:
+        row = None
+    return key, row[0] if row else None
+
+
+def update_cache(cache: sqlite3.Connection, new_hashes: list = (), removed: list = ()):
+    """
+    Writes new hashes into cache, drops hashes of removed files and closes cache.
+    Cache is left as it is if it can't be written.
+
+    :param cache: Sqlite connection (open_cache())
+    :param new_hashes: List of cache rows for hashed files
+    :param removed: List of paths to removed files
+    """
+    try:
+        with cache:
+            cache.executemany(
+                "DELETE FROM hashes WHERE path = ?", [(os.path.abspath(p),) for p in removed]
+            )
+            cache.executemany(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)", new_hashes
+            )
+    except sqlite3.Error:
+        pass
+    finally:
+        cache.close()
+
+
+def check_hashes(
+    files: list,
+    size: int,
+    executor: ThreadPoolExecutor,
+    cached: dict = None,
+    new_hashes: list = None,
+):
+    """Takes list of paths to files with same size. Checks their hashes,
     then group hash duplicates into dict.
+    Files with cached hashes are not read. If more than one file has to be hashed
+    and files are larger than two blocks, they are first grouped by partial hash,
+    so only files with same head and tail are hashed fully.
+    Files are hashed concurrently in given thread pool.
 
     :param files: List of paths to files
+    :param size: Size of files in bytes
+    :param executor: Thread pool for hashing
+    :param cached: Dict {path: (cache row key, cached hash or None)} (get_cached_hash())
+    :param new_hashes: List to collect cache rows for hashed files
     :return: Dict {hash: [duplicate files paths]}
     """
+    if cached is None:
+        file_hashes = dict.fromkeys(files)
+    else:
+        file_hashes = {file: cached[file][1] for file in files}
+    to_hash = [file for file, hash_file in file_hashes.items() if not hash_file]
+    if len(to_hash) > 1 and size > 2 * PARTIAL_BLOCK:
+        partial = {}
+        for file, partial_hash in zip(files, executor.map(get_partial_hash, files)):
+            partial.setdefault(partial_hash, []).append(file)
+        candidates = {file for group in partial.values() if len(group) > 1 for file in group}
+        to_hash = [file for file in to_hash if file in candidates]
+    for file, hash_file in zip(to_hash, executor.map(get_hash, to_hash, [size] * len(to_hash))):
+        file_hashes[file] = hash_file
+        if cached is not None:
+            new_hashes.append((*cached[file][0], hash_file))
     hashes_dict = {}
-    for file in files:
-        with open(file, "rb") as f:
-            file_content = f.read()
-        hash_file = hashlib.md5(file_content).hexdigest()
-        if not hashes_dict.get(hash_file):
-            hashes_dict.update({hash_file: [file]})
-        else:
-            hashes_dict[hash_file].append(file)
-    for k in tuple(hashes_dict.keys()):
-        if len(hashes_dict[k]) < 2:
-            del hashes_dict[k]
-    return hashes_dict
+    for file, hash_file in file_hashes.items():
+        if hash_file:
+            hashes_dict.setdefault(hash_file, []).append(file)
+    return {hsh: dup for hsh, dup in hashes_dict.items() if len(dup) > 1}
 
 
-def get_duplicates(lst: defaultdict, srt: bool):
+def get_duplicates(lst: dict, srt_sizes: list):
     """
     Returns a dict of duplicates grouped by size and hash.
+    Pairs of same size files without cached hashes are compared block by block,
+    so reading stops at first difference. Files removed since scanning are skipped.
 
-    :param lst: List of paths to files
-    :param srt: False - Descending order; True - Ascending
+    :param lst: Dict of files paths grouped by size(key=size)
+    :param srt_sizes: Sorted list of sizes (keys of lst)
     :return: Dictionary of duplicates {size: {hash: [ paths ]}}
     """
     duplicates = {}
-    srt_sizes = sorted(lst.keys(), reverse=srt)
-    for size in srt_sizes:
-        hashes_dict = check_hashes(lst[size])
-        if hashes_dict and hashes_dict.items():
-            duplicates[size] = hashes_dict
+    cache = open_cache()
+    new_hashes = []
+    cached = {}
+    removed = []
+    if cache:
+        for size in srt_sizes:
+            cached[size] = {}
+            for file in lst[size]:
+                found = get_cached_hash(cache, file)
+                if found:
+                    cached[size][file] = found
+                else:
+                    removed.append(file)
+    groups = {size: list(cached[size]) if cache else lst[size] for size in srt_sizes}
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        pairs = {
+            size: executor.submit(compare_files, *groups[size], size)
+            for size in srt_sizes
+            if len(groups[size]) == 2
+            and not any(hash_file for _, hash_file in cached.get(size, {}).values())
+        }
+        for size in srt_sizes:
+            if len(groups[size]) < 2:
+                continue
+            if size in pairs:
+                hash_file = pairs[size].result()
+                if hash_file:
+                    duplicates[size] = {hash_file: groups[size]}
+                    if cache:
+                        new_hashes.extend((*key, hash_file) for key, _ in cached[size].values())
+                continue
+            hashes_dict = check_hashes(groups[size], size, executor, cached.get(size), new_hashes)
+            if hashes_dict and hashes_dict.items():
+                duplicates[size] = hashes_dict
+    if cache:
+        update_cache(cache, new_hashes, removed)
     return duplicates
 
 
-def print_files_duplicates(duplicates: dict):
+def enumerate_duplicates(duplicates: dict):
     """
-    Prints files from duplicates dict. Groups them by size,
-    hash and numerates them.
+    Yields numerated files from duplicates dict.
 
-    :param duplicates:  Duplicates dict {size: {hash: [ paths ]}}
+    :param duplicates: Duplicates dict {size: {hash: [ paths ]}}
+    :return: Generator of tuples (number, size, hash, path)
     """
     count = 1
     for size, hashes_dict in duplicates.items():
-        if hashes_dict and hashes_dict.items():
-            print()
-            print(size, "bytes")
-            for hsh, dup in hashes_dict.items():
-                print(f"Hash: {hsh}")
-                for path in dup:
-                    print(f"{count}. {path}")
-                    count += 1
+        for hsh, dup in hashes_dict.items():
+            for path in dup:
+                yield count, size, hsh, path
+                count += 1
 
 
-def get_duplicates_paths(duplicates: dict):
+def print_files_duplicates(duplicates: dict):
     """
-    Returns a dict with numerated files paths from duplicates dict for further deleting.
+    Prints files from duplicates dict. Groups them by size,
+    hash and numerates them. Returns printed files by their numbers
+    for further deleting.
 
     :param duplicates: Duplicates dict {size: {hash: [ paths ]}}
-    :return: Dict with numerated paths {1: "path", 2: "path",}
+    :return: Dict with numerated paths {0: ("path", size), 1: ("path", size),}
     """
     paths = {}
-    count = 0
-    for size, d in duplicates.items():
-        for p in d.values():
-            for path in p:
-                paths[count] = (path, size)
-                count += 1
+    out = []
+    last_size = last_hash = None
+    for count, size, hsh, path in enumerate_duplicates(duplicates):
+        if size != last_size:
+            out.append("")
+            out.append(f"{size} bytes")
+            last_size, last_hash = size, None
+        if hsh != last_hash:
+            out.append(f"Hash: {hsh}")
+            last_hash = hsh
+        out.append(f"{count}. {path}")
+        paths[count - 1] = (path, size)
+        if len(out) >= OUTPUT_LINES:
+            write_lines(out)
+    write_lines(out)
     return paths
 
 
@@ -165,33 +492,55 @@ def ask_files_numbers(count: int):
     :param count: Number of existing files.
     :return: Tuple of files indexes
     """
-    numbers = [str(i + 1) for i in range(count)]
     rep = input("\nEnter file numbers to delete:\n").split()
     while True:
-        if rep:
-            for i in rep:
-                if i not in numbers:
-                    break
-            else:
-                return tuple(int(x) - 1 for x in set(rep))
+        try:
+            numbers = {int(i) - 1 for i in rep}
+        except ValueError:
+            numbers = None
+        if numbers and all(0 <= i < count for i in numbers):
+            return tuple(numbers)
         print("\nWrong option\n")
         rep = input("Enter file numbers to delete:\n").split()
 
 
+def remove_file(path: str):
+    """
+    Removes file.
+
+    :param path: Path to file
+    :return: None if file is removed, otherwise OSError
+    """
+    try:
+        os.remove(path)
+    except OSError as e:
+        return e
+
+
 def delete_files(paths: dict, numbers: tuple):
     """
     Deletes files with given keys from dict of paths.
+    Files that could not be deleted are reported and not counted.
 
-    :param paths: Dict with numerated paths (get_duplicates_paths())
+    :param paths: Dict with numerated paths (print_files_duplicates())
     :param numbers: Tuple with keys for files to delete
     :return: Prints total freed up space in bytes
     """
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        errors = list(executor.map(remove_file, (paths[numb][0] for numb in numbers)))
     mem = 0
-    for numb in paths:
-        if numb in numbers:
-            os.remove(paths[numb][0])
-            mem += paths[numb][1]
+    removed = []
+    for numb, error in zip(numbers, errors):
+        path, size = paths[numb]
+        if error:
+            print(f"\nCould not delete {path}: {error.strerror}")
+        else:
+            mem += size
+            removed.append(path)
     print(f"\nTotal freed up space: {mem} bytes")
+    cache = open_cache()
+    if cache:
+        update_cache(cache, removed=removed)
 
 
 def main():
@@ -201,12 +550,12 @@ def main():
     form = input("Enter file format:\n")
     srt = choice_sorting()
     lst = get_files(path, form)
-    print_files(lst, srt)
+    srt_sizes = sorted(lst, reverse=srt)
+    print_files(lst, srt_sizes)
     if ask_yes_no("Check for duplicates?"):
-        duplicates = get_duplicates(lst, srt)
-        print_files_duplicates(duplicates)
+        duplicates = get_duplicates(lst, srt_sizes)
+        paths = print_files_duplicates(duplicates)
         if ask_yes_no("Delete files?"):
-            paths = get_duplicates_paths(duplicates)
             files_numbers = ask_files_numbers(len(paths.keys()))
             delete_files(paths, files_numbers)
 